@@ -1,9 +1,17 @@
 import sqlite3
 import csv
-import urllib.request
+import codecs
+import functools
+import gzip
+import hashlib
+import http.client
+import io
+import itertools
+import os
+import urllib.parse
 import json
+import re
 import datetime as dt
-from datetime import datetime, date
 from pathlib import Path
 from html import escape
 
@@ -84,116 +92,285 @@ SENDAI_EVENTS_CSV_URL = "https://data.city.sendai.jp/datastore/dump/2314f2dc-da9
 # ===== DB =====
 DDL = """
 CREATE TABLE IF NOT EXISTS events (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  id INTEGER PRIMARY KEY,
   source TEXT,
   source_id TEXT,
   title TEXT,
   summary TEXT,
   url TEXT,
   start_at TEXT,
+  start_day TEXT,
+  weekday INTEGER,
   area TEXT,
   venue_name TEXT,
   price_band TEXT,
   tags_json TEXT,
-  kid_score INTEGER
+  kid_score INTEGER,
+  UNIQUE(source, source_id)
+);
+CREATE INDEX IF NOT EXISTS idx_events_start_day ON events(start_day);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
 );
 """
 
 def connect_db():
     print("USING DB:", DB_PATH)
     DATA_DIR.mkdir(exist_ok=True)
-    con = sqlite3.connect(DB_PATH)
+    # isolation_level=None: 暗黙のトランザクション管理をやめて、importでは明示的に
+    # BEGIN IMMEDIATE ... COMMIT を発行する（それ以外は自動コミット）
+    con = sqlite3.connect(DB_PATH, isolation_level=None)
+    # WAL + synchronous=NORMAL でcommitごとのfsyncを減らす（全消し→再投入の用途なら十分）
+    con.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+        PRAGMA mmap_size=268435456;
+    """)
+    # 旧スキーマのDB（start_day/weekday列やUNIQUE(source, source_id)が無い）は
+    # CREATE TABLE IF NOT EXISTSでは直らない。データは毎回全量取り込み直すので、
+    # 古ければテーブルごと作り直す
+    cols = [r[1] for r in con.execute("PRAGMA table_info(events)").fetchall()]
+    if cols:
+        has_unique = any(r[3] == "u" for r in con.execute("PRAGMA index_list(events)").fetchall())
+        if "start_day" not in cols or "weekday" not in cols or not has_unique:
+            print("Old events schema detected, recreating table")
+            con.execute("DROP TABLE events")
+            # ETagが残っていると304でスキップされて空のままになるので一緒に消す
+            if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'meta'").fetchone():
+                con.execute("DELETE FROM meta")
+
     con.executescript(DDL)
     return con
 
-# ===== CSV取得 =====
-def download_csv(url: str):
-    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-    with urllib.request.urlopen(req) as r:
-        raw = r.read()
+def get_meta(con, key):
+    row = con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
 
-    for enc in ("utf-8-sig", "utf-8", "cp932"):
-        try:
-            text = raw.decode(enc)
-            break
-        except:
+def set_meta(con, key, value):
+    con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+# ===== HTTP =====
+_CONNS = {}  # (scheme, host) -> keep-aliveな接続。同一ホストの追加フェッチでTLSハンドシェイクを省く
+
+def _http_get(url: str, headers: dict):
+    # urlopenと違ってhttp.clientはリダイレクトを辿らないので、ここでLocationを追う
+    for _ in range(5):
+        resp = _http_get_once(url, headers)
+        if resp.status in (301, 302, 303, 307, 308) and resp.headers.get("Location"):
+            resp.read()  # keep-alive再利用のためボディを読み切っておく
+            url = urllib.parse.urljoin(url, resp.headers["Location"])
             continue
-    else:
-        text = raw.decode("utf-8", errors="replace")
+        return resp
+    raise RuntimeError(f"リダイレクトが多すぎます: {url}")
+
+def _http_get_once(url: str, headers: dict):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    for attempt in (1, 2):
+        con = _CONNS.get(key)
+        if con is None:
+            cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            con = _CONNS[key] = cls(parts.netloc, timeout=60)
+        try:
+            con.request("GET", path, headers=headers)
+            return con.getresponse()
+        except (http.client.HTTPException, OSError):
+            # keep-aliveが切れていたら接続を作り直して1回だけリトライ
+            con.close()
+            _CONNS.pop(key, None)
+            if attempt == 2:
+                raise
 
-    if "<html" in text.lower():
+# ===== CSV取得 =====
+def download_csv(url: str, etag=None, last_modified=None):
+    headers = {
+        "User-Agent": "Mozilla/5.0",
+        "Accept-Encoding": "gzip",  # 展開できるのはgzipだけなのでdeflateは要求しない
+    }
+    # 前回のETag/Last-Modifiedを付けて、変更なしなら304で転送をスキップ
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    resp = _http_get(url, headers)
+    if resp.status == 304:
+        resp.read()  # keep-alive再利用のためボディを読み切っておく
+        return None
+
+    # urlopenと違ってhttp.clientは4xx/5xxで例外を投げないので、ここで止める
+    # （エラーページをCSVとして取り込んでDBを空にしないこと）
+    if resp.status != 200:
+        resp.read()
+        raise RuntimeError(f"CSV取得に失敗しました: HTTP {resp.status}")
+
+    r = resp
+    # gzipで返ってきたら展開しながらストリームする（転送量が約1/4になる）
+    if resp.headers.get("Content-Encoding") == "gzip":
+        r = gzip.GzipFile(fileobj=resp)
+
+    # エンコーディング判定: BOM → Content-Typeのcharset → utf-8（ダメならcp932）
+    # 全体を試しデコードせず、先頭を覗くだけで決める
+    sniff = r.peek(2048)
+    if sniff.startswith(codecs.BOM_UTF8):
+        enc = "utf-8-sig"
+    else:
+        m = re.search(r"charset=([\w.-]+)", resp.headers.get("Content-Type") or "")
+        if m:
+            enc = m.group(1)
+        else:
+            enc = "utf-8"
+            try:
+                # incrementaldecoderなら末尾でマルチバイト文字が切れていてもエラーにならない
+                codecs.getincrementaldecoder(enc)().decode(sniff, final=False)
+            except UnicodeDecodeError:
+                enc = "cp932"
+
+    if b"<html" in sniff.lower():
         raise RuntimeError("CSVではなくHTMLを取得しています")
 
-    return list(csv.DictReader(text.splitlines()))
+    # decode→splitlines→list をやめて、レスポンスから直接csv.readerに流す
+    text = io.TextIOWrapper(r, encoding=enc, errors="replace", newline="")
+    reader = csv.reader(text)
+    header = next(reader, [])
+    return header, reader, resp.headers
 
 # ===== 取り込み =====
+BATCH = 500  # executemany 1回あたりの行数
+
+# 子ども向けキーワードは1個の正規表現にまとめて1回の走査で判定する
+KID_PAT = re.compile("小学生|親子|子ども|体験|工作")
+
+# tags_jsonは4通りしかないので(elem, free)ごとに事前シリアライズしておく
+TAG_JSON = {
+    (elem, free): json.dumps(
+        {k: True for k, v in (("elem", elem), ("free", free)) if v},
+        ensure_ascii=False,
+    )
+    for elem in (False, True)
+    for free in (False, True)
+}
+
 def import_sendai_events(con):
-    rows = download_csv(SENDAI_EVENTS_CSV_URL)
-    print("CSV columns:", rows[0].keys())
+    got = download_csv(
+        SENDAI_EVENTS_CSV_URL,
+        etag=get_meta(con, "csv_etag"),
+        last_modified=get_meta(con, "csv_last_modified"),
+    )
+    if got is None:
+        print("CSV not modified (304), skipping import")
+        return
 
-    cur = con.cursor()
-    cur.execute("DELETE FROM events")
+    header, rows, resp_headers = got
+    print("CSV columns:", header)
+
+    # 列indexは1回だけ解決しておく（行ごとのdict生成/.get()をやめる）
+    def col(name):
+        return header.index(name) if name in header else -1
+
+    i_name = col("name")
+    i_summary = col("summary")
+    i_start = col("startDate")
+    i_venue = col("locationName")
+    i_url = col("detailedUrl")
+    i_entity = col("entity_id")
+    i_id = col("_id")
+
+    def get(row, i):
+        return row[i] if 0 <= i < len(row) else ""
 
     count = 0
-    for r in rows:
-        title = (r.get("name") or "").strip()
-        if not title:
-            continue
 
-        summary = r.get("summary") or ""
-        start = r.get("startDate") or ""
-        venue = r.get("locationName") or ""
-        url = r.get("detailedUrl") or ""
-        source_id = r.get("entity_id") or r.get("_id") or title + start
-
-        text = title + summary
-        tags = {}
-        score = 60
-
-        if any(x in text for x in ["小学生", "親子", "子ども", "体験", "工作"]):
-            tags["elem"] = True
-            score = 80
-        if "無料" in text:
-            tags["free"] = True
-
-        cur.execute(
-            """
-            INSERT INTO events
-            (source, source_id, title, summary, url, start_at, area, venue_name, price_band, tags_json, kid_score)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
+    def gen():
+        nonlocal count
+        for row in rows:
+            title = get(row, i_name).strip()
+            if not title:
+                continue
+
+            summary = get(row, i_summary)
+            start = get(row, i_start)
+            venue = get(row, i_venue)
+            url = get(row, i_url)
+            source_id = get(row, i_entity) or get(row, i_id) or title + start
+
+            text = title + summary
+            has_elem = KID_PAT.search(text) is not None
+            has_free = "無料" in text
+            score = 80 if has_elem else 60
+
+            # 日付は取り込み時に1回だけ正規化しておく（ビルド側でのパースをなくす）
+            try:
+                d = dt.date.fromisoformat(start[:10])
+                start_day = d.isoformat()
+                weekday = d.weekday()
+            except ValueError:
+                start_day = ""
+                weekday = None
+
+            count += 1
+            yield (
                 "sendai_csv",
                 source_id,
                 title,
                 summary,
                 url,
                 start,
+                start_day,
+                weekday,
                 "仙台市",
                 venue,
-                "free" if tags.get("free") else "unknown",
-                json.dumps(tags, ensure_ascii=False),
+                "free" if has_free else "unknown",
+                TAG_JSON[(has_elem, has_free)],
                 score,
             )
-        )
-        count += 1
 
-    con.commit()
-    print(f"Imported sendai events: {count}")
+    # 1トランザクションでDELETE+再INSERT（行ごとのcommitをやめて高速化）
+    # SQLiteの変数上限とメモリを考えてBATCH行ずつexecutemanyする
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("DELETE FROM events")
+        it = gen()
+        while True:
+            chunk = list(itertools.islice(it, BATCH))
+            if not chunk:
+                break
+            cur.executemany(
+                """
+                INSERT OR REPLACE INTO events
+                (source, source_id, title, summary, url, start_at, start_day, weekday, area, venue_name, price_band, tags_json, kid_score)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """,
+                chunk,
+            )
+        cur.execute("COMMIT")
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
 
-# ===== HTML =====
-from datetime import datetime
+    # 取り込みが成功してから検証用ヘッダを保存する
+    set_meta(con, "csv_etag", resp_headers.get("ETag") or "")
+    set_meta(con, "csv_last_modified", resp_headers.get("Last-Modified") or "")
 
-def html(title, body):
-    v = datetime.now().strftime("%Y%m%d%H%M")  # 毎回変わる
+    print(f"Imported sendai events: {count}")
 
+# ===== HTML =====
+def html(title, body, css_v):
     return f"""<!doctype html>
 <html lang="ja">
 <head>
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width, initial-scale=1">
 <title>{escape(title)}</title>
-<link rel="stylesheet" href="style.css?v={v}">
+<link rel="stylesheet" href="style.css?v={css_v}">
 </head>
 <body>
 <header><h1>宮城の子どもイベント</h1></header>
@@ -205,20 +382,38 @@ def html(title, body):
 </html>
 """
 
+@functools.lru_cache(maxsize=4096)
+def _is_weekend_day(day: str) -> bool:
+    try:
+        return dt.date.fromisoformat(day).weekday() in (5, 6)  # 土日
+    except ValueError:
+        return False
+
 def _is_weekend(start_at: str) -> bool:
     # start_at: "YYYY-MM-DD..." を想定（T区切りでもOK）
+    # 曜日は日付部分だけで決まるので、先頭10文字をキーにしてキャッシュする
     if not start_at:
         return False
-    s = start_at.strip().replace("T", " ")
-    try:
-        d = datetime.fromisoformat(s[:19] if len(s) >= 19 else s[:10] + " 00:00:00")
-        return d.weekday() in (5, 6)  # 土日
-    except:
-        return False
+    return _is_weekend_day(start_at.strip()[:10])
+
+# 改行コード→スペースの変換表（summary整形用）
+_NL_TABLE = {0x0A: 0x20, 0x0D: 0x20}
+
+def atomic_write(path, data, encoding="utf-8"):
+    # 一時ファイルに書いてos.replaceで差し替える（配信中に途中までのHTMLを読ませない）
+    if isinstance(data, str):
+        data = data.encode(encoding)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
 def build_site(con):
     SITE_DIR.mkdir(parents=True, exist_ok=True)
-    (SITE_DIR / "style.css").write_text(CSS, encoding="utf-8")
+    css_bytes = CSS.encode("utf-8")
+    atomic_write(SITE_DIR / "style.css", css_bytes)
+
+    # キャッシュバスターは時刻ではなく内容ハッシュ（CSSが変わらなければURLも変わらない）
+    css_v = hashlib.blake2b(css_bytes, digest_size=8).hexdigest()
 
     today = dt.date.today().isoformat()
     updated = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -235,54 +430,76 @@ def build_site(con):
     url_col = next((c for c in url_candidates if c in cols), None)
 
     # SELECT文を組み立て（URL列が無ければ空文字を入れる）
-    if url_col:
-        sql = f"SELECT title, summary, start_at, venue_name, {url_col} FROM events"
+    url_expr = url_col if url_col else "''"
+    sql = f"SELECT title, summary, start_day, venue_name, {url_expr} FROM events"
+
+    # 日付は取り込み時に正規化済み（不正な日付は start_day='' になっている）。
+    # 絞り込み・並べ替え・件数制限はSQL側でやる（Pythonで全行なめない）
+    future = con.execute(
+        f"{sql} WHERE start_day >= ? ORDER BY start_day LIMIT 100",
+        (today,),
+    ).fetchall()
+
+    if future:
+        show = future
     else:
-        sql = "SELECT title, summary, start_at, venue_name, '' as url FROM events"
-
-    rows = con.execute(sql).fetchall()
-
-    future, past = [], []
-
-    for t, s, start_at, venue, url in rows:
-        start_day = (start_at or "")[:10]
-        if start_day.count("-") != 2:
-            continue
-
-        item = (t, s, start_day, venue, url)
-
-        if start_day >= today:
-            future.append(item)
-        else:
-            past.append(item)
-
-    show = future if future else past[-20:]
-
-    body = f"<p class='meta'>更新: {updated}</p>"
-    body += "<h2>これからのイベント</h2>" if future else "<h2>直近のイベント（過去）</h2>"
+        past = con.execute(
+            f"{sql} WHERE start_day != '' AND start_day < ? ORDER BY start_day DESC LIMIT 20",
+            (today,),
+        ).fetchall()
+        show = past[::-1]
+
+    # 表示内容のハッシュが前回と同じならHTMLを書き直さない（更新時刻だけの差分で
+    # デプロイやgitの履歴を汚さない）
+    h = hashlib.sha256()
+    h.update(css_v.encode())
+    h.update(b"future" if future else b"past")
+    for row in show:
+        h.update(repr(row).encode("utf-8"))
+    site_hash = h.hexdigest()
+
+    if site_hash == get_meta(con, "site_hash") and (SITE_DIR / "index.html").exists():
+        print("Site content unchanged, skipping write")
+        return
+
+    # 文字列の += はカード数に対して二乗で効くので、listに溜めて最後にjoinする
+    parts = [f"<p class='meta'>更新: {updated}</p>"]
+    parts.append("<h2>これからのイベント</h2>" if future else "<h2>直近のイベント（過去）</h2>")
+
+    _esc = escape  # ループ内のグローバル参照を減らす
 
     for t, s, start_day, venue, url in show:
-        desc = (s or "").replace("\n", " ").replace("\r", " ").strip()
+        # 改行→スペースはtranslateで1パスに
+        desc = (s or "").translate(_NL_TABLE).strip()
         if len(desc) > 140:
             desc = desc[:140] + "…"
 
-        title_html = escape(t)
+        title_html = _esc(t)
         if url:
-            title_html = f'<a href="{escape(url)}" target="_blank" rel="noopener noreferrer">{escape(t)}</a>'
+            title_html = f'<a href="{_esc(url)}" target="_blank" rel="noopener noreferrer">{_esc(t)}</a>'
 
-        body += f"""
+        parts.append(f"""
 <div class="card">
   <h3>{title_html}</h3>
-  <div class="meta">{escape(start_day)} / {escape(venue or "")}</div>
-  <div>{escape(desc)}</div>
+  <div class="meta">{_esc(start_day)} / {_esc(venue or "")}</div>
+  <div>{_esc(desc)}</div>
 </div>
-"""
+""")
 
-    (SITE_DIR / "index.html").write_text(
-        html("宮城の子どもイベント", body),
-        encoding="utf-8"
+    body = "".join(parts)
+
+    page = html("宮城の子どもイベント", body, css_v)
+    atomic_write(SITE_DIR / "index.html", page)
+
+    # 事前圧縮版も置いておく（gzip_static等のホストはこちらをそのまま配れる）
+    # mtime=0 で内容が同じなら.gzもバイト単位で同じになる
+    atomic_write(
+        SITE_DIR / "index.html.gz",
+        gzip.compress(page.encode("utf-8"), compresslevel=9, mtime=0),
     )
 
+    set_meta(con, "site_hash", site_hash)
+
 def main():
     con = connect_db()
     import_sendai_events(con)